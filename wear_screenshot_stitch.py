@@ -23,16 +23,42 @@ from __future__ import print_function
 
 import hashlib
 import math
+import mmap
 import os
 import os.path
+import shlex
 import subprocess
 import sys
 import time
 import argparse
 
 from collections import defaultdict
+from concurrent import futures
+from functools import lru_cache
 from PIL import Image
 
+import numpy as np
+
+# Numba is optional; when available the row-hash kernel is JIT-compiled.
+try:
+  from numba import njit
+except ImportError:
+  njit = None
+
+# xxhash is optional; when available rows are hashed with xxHash instead of
+# the polynomial hash.
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
+
+# OpenCV is optional; when available it decodes PNGs with its SIMD-enabled
+# codecs, straight into an array.
+try:
+  import cv2
+except ImportError:
+  cv2 = None
+
 HASH_MODULO = 2**64
 HASH_MULTIPLIER = 31
 
@@ -44,17 +70,62 @@ ENDC = "\033[0m"
 
 def adb(adb_args, command):
   """Runs an adb command, discarding the result."""
-  cmd = "adb {} {}".format(adb_args, command)
-  print("Executing adb command: " + cmd)
-  subprocess.call(cmd, shell=True)
+  cmd = ["adb"] + shlex.split(adb_args) + shlex.split(command)
+  print("Executing adb command: " + " ".join(cmd))
+  try:
+    subprocess.call(cmd)
+  except OSError:
+    pass  # e.g. adb is not installed; handled when the capture comes back
+
+
+def adb_screencap(adb_args):
+  """Captures the device's screen, returning the PNG data.
+
+  The image is streamed straight over adb, avoiding a write to the device's
+  storage and a separate pull. Returns None if the capture failed.
+  """
+  cmd = ["adb"] + shlex.split(adb_args) + ["exec-out", "screencap", "-p"]
+  print("Executing adb command: " + " ".join(cmd))
+  try:
+    return subprocess.check_output(cmd)
+  except (subprocess.CalledProcessError, OSError):
+    return None
+
+
+def load_rgba(path):
+  """Decodes an image file into an RGBA uint8 array."""
+  if cv2 is not None:
+    arr = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if arr is not None:
+      if arr.ndim == 2:
+        return cv2.cvtColor(arr, cv2.COLOR_GRAY2RGBA)
+      if arr.shape[2] == 3:
+        return cv2.cvtColor(arr, cv2.COLOR_BGR2RGBA)
+      return cv2.cvtColor(arr, cv2.COLOR_BGRA2RGBA)
+  return np.asarray(Image.open(path).convert("RGBA"))
+
+
+if njit is not None:
+  @njit(cache=True)
+  def _row_hashes_jit(mid):
+    """Computes the polynomial hash of each row of a uint64 array."""
+    height = mid.shape[0]
+    out = np.empty(height, dtype=np.uint64)
+    for y in range(height):
+      row_hash = np.uint64(1)
+      for x in range(mid.shape[1]):
+        row_hash = row_hash * np.uint64(HASH_MULTIPLIER) + mid[y, x]
+      out[y] = row_hash
+    return out
 
 
-def rgb_to_int(x):
-  """Converts an rgb/rgba tuple into an int"""
-  r = x[0]
-  g = x[1]
-  b = x[2]
-  return (r * 0x10000) + (g * 0x100) + b
+def file_md5(path):
+  """Returns a file's md5 without copying it into a Python bytes object."""
+  with open(path, "rb") as f:
+    if hasattr(hashlib, "file_digest"):  # Python 3.11+
+      return hashlib.file_digest(f, "md5").hexdigest()
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      return hashlib.md5(mm).hexdigest()
 
 
 def get_row_hashes(capture_file):
@@ -63,26 +134,70 @@ def get_row_hashes(capture_file):
   Each hash represents the contents of the middle of the row.
   """
 
-  im = Image.open(capture_file)
-  row_hashes = []
-  (width, height) = im.size
-
-  # A simple hash function, using the pixel values as coefficients
-  # of a polynomial. Note: we only use data from the middle of the row,
-  # as on a round screen, left and right edges get cut off.
-  for y in range(height):
-    row_hash = 1
-    for x in range(int(width * 0.3), int(width * 0.7)):
-      row_hash *= HASH_MULTIPLIER
-      row_hash += rgb_to_int(im.getpixel((x, y)))
-      row_hash %= HASH_MODULO
-    row_hashes.append(row_hash)
-  return row_hashes
+  arr = load_rgba(capture_file)
+  (height, width) = arr.shape[:2]
+
+  # The hashes are only ever compared for equality, so any stable hash of
+  # the middle of the row will do. Note: we only use data from the middle
+  # of the row, as on a round screen, left and right edges get cut off.
+  mid_lo = int(width * 0.3)
+  mid_hi = int(width * 0.7)
+
+  # Prefer xxHash, which digests each row's raw bytes in a single C call.
+  if xxhash is not None:
+    middle_band = np.ascontiguousarray(arr[:, mid_lo:mid_hi])
+    return [xxhash.xxh3_64_intdigest(middle_band[y].tobytes())
+            for y in range(height)]
+
+  # Otherwise, fall back to a simple hash function using the pixel values as
+  # coefficients of a polynomial. Each RGBA pixel is already four contiguous
+  # bytes, so viewing the buffer as uint32 packs it for free.
+  packed = np.ascontiguousarray(arr).view(np.uint32).reshape(height, width)
+  mid = packed[:, mid_lo:mid_hi].astype(np.uint64)
+
+  # Horner evaluation of the polynomial. As HASH_MODULO is 2**64, the
+  # reduction modulo happens for free when the uint64 arithmetic wraps
+  # around. Prefer the JIT-compiled kernel, which hashes each row in one
+  # tight native loop, over the column-at-a-time NumPy reduction.
+  if njit is not None:
+    row_hashes = _row_hashes_jit(mid)
+  else:
+    row_hashes = np.ones(height, dtype=np.uint64)
+    for x in range(mid.shape[1]):
+      row_hashes = row_hashes * HASH_MULTIPLIER + mid[:, x]
+  return row_hashes.tolist()
+
+def find_best_offset(previous_row_hashes, row_hashes):
+  """Finds the y-offset at which an image best lines up with its predecessor.
+
+  The score of an offset is the number of rows whose hashes match when the
+  new image is shifted down by that amount. Rather than rescanning every row
+  for every offset, bucket the previous image's rows by hash and let each
+  matching pair of rows vote for the offset that would align them. As long
+  as most rows hash differently, this is near-linear in the image height.
+  Returns (best_score, best_offset).
+  """
+  rows_with_hash = defaultdict(list)
+  for (z, row_hash) in enumerate(previous_row_hashes):
+    rows_with_hash[row_hash].append(z)
+
+  scores = defaultdict(int)
+  for (z, row_hash) in enumerate(row_hashes):
+    for previous_z in rows_with_hash.get(row_hash, ()):
+      if previous_z >= z:
+        scores[previous_z - z] += 1
+
+  # Break score ties in favour of the largest offset, as before.
+  return max((scores[offset], offset)
+             for offset in range(len(previous_row_hashes)))
+
+@lru_cache(maxsize=None)
+def _index_format(max):
+  index_chars = int(math.ceil(math.log10(max)))
+  return '{{:0{}d}}'.format(index_chars)
 
 def padded_index(max, num):
-  index_chars = int(math.ceil(math.log10(max)))
-  index_format = '{{:0{}d}}'.format(index_chars)
-  return index_format.format(num)
+  return _index_format(max).format(num)
 
 def find_next_file_name(dir, file_base, max):
   base = os.path.join(dir, file_base)
@@ -143,105 +258,179 @@ def main(args):
   if args.capture:
     rm_captures(cap_dir, cap_file_prefix)
 
+  # Futures for row hashes computed in the background during capture, keyed
+  # by image id. Hashing a frame overlaps with the adb round-trips for the
+  # next one.
+  hash_futures = {}
+
   if args.capture:
     # Capture screenshots from the device, sending a small swipe gesture after each.
     # Stop when we get two identical screenshots in a row (this indicates that we're
     # at the bottom of the UI) or we hit the iteration limit.
     old_md5sum = ""
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+      for i in range(image_count):
+        cap_file = get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, i)
+        print("Capturing image {}".format(i))
+        data = adb_screencap(args.adb_args)
+        if not data:
+          print(FAIL + "Failed to capture screenshot. Is your device connected?" + ENDC)
+          return
+        adb(args.adb_args, "shell input swipe 50 200 50 100")
+        with open(cap_file, "wb") as f:
+          f.write(data)
+
+        md5sum = hashlib.md5(data).hexdigest()
+
+        if md5sum == old_md5sum:
+          image_count = i
+          break
+        old_md5sum = md5sum
+        hash_futures[i] = executor.submit(get_row_hashes, cap_file)
+        time.sleep(args.inter_capture_delay / 1000)  # Give time for scrollbar to disappear
+
+  hash_executor = None
+  if not args.capture and image_count > 1:
+    # The frames already exist on disk and each one needs decoding and
+    # hashing, with no shared state, so spread the work across cores.
+    # Byte-identical frames (e.g. a kept duplicate trailing capture) share
+    # a single hash job, keyed by file md5.
+    hash_executor = futures.ProcessPoolExecutor()
+    future_for_md5 = {}
     for i in range(image_count):
-      index = padded_index(args.max_captures, i)
-      cap_file = get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, i)
-      print("Capturing image {}".format(i))
-      adb(args.adb_args, "shell screencap -p /sdcard/{}.png".format(index))
-      adb(args.adb_args, "shell input swipe 50 200 50 100")
-      adb(args.adb_args, "pull /sdcard/{}.png {}".format(index, cap_file))
-      if not os.path.exists(cap_file):
-        print(FAIL + "Failed to capture screenshot. Is your device connected?" + ENDC)
-        return
-
-      md5sum = hashlib.md5(
-          open(cap_file, "rb").read()).hexdigest()
-
-      if md5sum == old_md5sum:
-        image_count = i
-        break
-      old_md5sum = md5sum
-      time.sleep(args.inter_capture_delay / 1000)  # Give time for scrollbar to disappear
+      path = get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, i)
+      md5sum = file_md5(path)
+      if md5sum not in future_for_md5:
+        future_for_md5[md5sum] = hash_executor.submit(get_row_hashes, path)
+      hash_futures[i] = future_for_md5[md5sum]
+
+  def hashes_for_image(i):
+    if i in hash_futures:
+      return hash_futures[i].result()
+    return get_row_hashes(
+        get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, i))
 
   # Examine the first image that was captured.
-  im = Image.open(get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, 0))
-  (width, height) = im.size
-
-  rows_for_absolute = defaultdict(list)
-  previous_row_hashes = get_row_hashes(
-    get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, 0))
-  absolute_offset = 0
+  first = load_rgba(get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, 0))
+  (height, width) = first.shape[:2]
 
-  for y in range(len(previous_row_hashes)):
-    rows_for_absolute[y].append((0, y))
+  previous_row_hashes = hashes_for_image(0)
+  absolute_offsets = [0]
 
   # For each subsequent image that was captured, find the y-offset at which it's
   # the closest match to the previous image.
   for i in range(1, image_count):
-    row_hashes = get_row_hashes(
-      get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, i))
+    row_hashes = hashes_for_image(i)
 
-    (best_score, best_offset) = max([(len([
-        z for z in range(0, height - offset)
-        if row_hashes[z] == previous_row_hashes[z + offset]
-    ]), offset) for offset in range(0, height)])
+    (best_score, best_offset) = find_best_offset(previous_row_hashes, row_hashes)
     print("Match for image {} - ({}, {})".format(i, best_score, best_offset))
 
-    absolute_offset += best_offset
-    for y in range(height):
-      rows_for_absolute[y + absolute_offset].append((i, y))
-
+    absolute_offsets.append(absolute_offsets[-1] + best_offset)
     previous_row_hashes = row_hashes
 
+  if hash_executor is not None:
+    hash_executor.shutdown()
+
+  # Decode each capture once up front. The stitching loop below reads pixels
+  # straight out of these arrays instead of re-opening the files for every
+  # output row.
+  # The compositor only ever moves whole pixels around, so view each RGBA
+  # frame as one uint32 word per pixel, quartering the elements it gathers.
+  frames = {}
+  for i in range(image_count):
+    arr = load_rgba(
+        get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, i))
+    frames[i] = np.ascontiguousarray(arr).view(np.uint32).reshape(arr.shape[:2])
+
   # Create an output image by overlaying each of the images captured at the
   # offsets we worked out earlier.
-  output_height = max(rows_for_absolute.keys()) + 1
+  output_height = max(absolute_offsets) + height
   print("Producting an image with height {}".format(output_height))
-  im_out = Image.new("RGBA", (width, output_height))
+
+  # Dense contributor tables: for each output row, which images cover it and
+  # at which row within each image. Each image covers a contiguous band of
+  # output rows, so the tables fill up with one slice write per image.
+  counts = np.zeros(output_height, dtype=np.int16)
+  for offset in absolute_offsets:
+    counts[offset:offset + height] += 1
+  max_contributors = int(counts.max())
+  contrib_img = np.full((output_height, max_contributors), -1, dtype=np.int16)
+  contrib_row = np.full_like(contrib_img, -1)
+  contrib_count = np.zeros(output_height, dtype=np.int16)
+  for (i, offset) in enumerate(absolute_offsets):
+    ys = np.arange(offset, offset + height)
+    contrib_img[ys, contrib_count[ys]] = i
+    contrib_row[ys, contrib_count[ys]] = np.arange(height)
+    contrib_count[ys] += 1
+
+  out_arr = np.zeros((output_height, width), dtype=np.uint32)
   middle = (height - 1) / 2
-  for y in range(output_height):
-    on_screen_pixels = defaultdict(list)
-    off_screen_pixels = defaultdict(list)
-    for (image_id, row) in rows_for_absolute[y]:
-      im = Image.open(get_capture_file_path(cap_dir, cap_file_prefix, args.max_captures, image_id))
-      for x in range(width):
-        if args.round:
-          hypot_squared = \
-            (((x - middle) ** 2) + ((row - middle) ** 2))
-          on_screen = hypot_squared < ((height / 2) - 2)**2
-        else:
-          on_screen = True
-        p = im.getpixel((x, row))
-
-        if on_screen:
-          on_screen_pixels[x].append((row, p))
-        else:
-          off_screen_pixels[x].append((row, p))
-
-    # For each pixel, we try to work out the most suitable color value for it
-    # in the final stitched image.
-    for x in range(width):
-      if not on_screen_pixels[x]:
-        if y >= height / 2 and y < (output_height - height / 2):
-          suggested_pixel = im_out.getpixel((x, y - 2))
-        else:
-          if args.transparency:
-            suggested_pixel = (0, 0, 0, 0)  # transparency
-          else:
-            (_, suggested_pixel) = min((math.fabs(row - middle), p)
-                                       for (row, p) in off_screen_pixels[x])
-      else:
-        (_, suggested_pixel) = min((math.fabs(row - middle), p)
-                                   for (row, p) in on_screen_pixels[x])
-      im_out.putpixel((x, y), suggested_pixel)
+
+  # Each source row's distance from the vertical middle of its frame, used
+  # to rank contributors below.
+  row_dist = np.abs(np.arange(height) - middle)
+
+  # The circle test only depends on a pixel's position within the captured
+  # frame, so evaluate it once as a boolean mask. On square screens every
+  # pixel is on screen.
+  if args.round:
+    ys, xs = np.ogrid[:height, :width]
+    on_screen_mask = \
+        ((xs - middle) ** 2 + (ys - middle) ** 2) < ((height / 2) - 2)**2
+  else:
+    on_screen_mask = np.ones((height, width), dtype=bool)
+
+  frames_stack = np.stack([frames[i] for i in range(image_count)])
+
+  # Rank each output row's contributors by distance to their frame's middle,
+  # once. Stable sorting keeps the earlier image first on equal distances,
+  # matching the argmin tie-breaking used previously. Absent contributors
+  # rank last.
+  dist_table = np.where(contrib_row >= 0, row_dist[contrib_row], np.inf)
+  order = np.argsort(dist_table, axis=1, kind="stable")
+  img_by_rank = np.take_along_axis(contrib_img, order, axis=1)
+  row_by_rank = np.take_along_axis(contrib_row, order, axis=1)
+
+  # For each pixel, the most suitable colour value comes from the on-screen
+  # contributor captured closest to the middle of its frame. Pass r writes,
+  # for every output pixel still unfilled, its rank-r contributor wherever
+  # that contributor is on screen, so the whole image is composed in
+  # max_contributors gathers with no per-row Python loop. The -1 entries of
+  # absent contributors wrap to valid indices but are masked out.
+  filled = np.zeros((output_height, width), dtype=bool)
+  for rank in range(max_contributors):
+    imgs = img_by_rank[:, rank]
+    rows = row_by_rank[:, rank]
+    candidates = frames_stack[imgs, rows]
+    take = on_screen_mask[rows] & (imgs >= 0)[:, np.newaxis] & ~filled
+    out_arr[take] = candidates[take]
+    filled |= take
+
+  # Pixels where every contributor was off screen: in the middle of the
+  # output we can reuse the row written two pixels up, while at the top and
+  # bottom we fall back to transparency or the nearest off-screen pixel.
+  # Rows are handled top to bottom so the two-pixels-up copy reads rows that
+  # are already complete.
+  for y in np.nonzero(~filled.all(axis=1))[0]:
+    no_on_screen = ~filled[y]
+    if y >= height / 2 and y < (output_height - height / 2):
+      fallback = out_arr[y - 2]
+    elif args.transparency:
+      fallback = np.zeros(width, dtype=np.uint32)
+    else:
+      k = contrib_count[y]
+      rows = contrib_row[y, :k]
+      pix = frames_stack[contrib_img[y, :k], rows]
+      off_dist = np.where(on_screen_mask[rows], np.inf,
+                          row_dist[rows][:, np.newaxis])
+      best_off = off_dist.argmin(axis=0)
+      fallback = pix[best_off, np.arange(width)]
+    out_arr[y, no_on_screen] = fallback[no_on_screen]
 
   # And we're done! Let the user know where to find the output image.
-  im_out.save(out_file)
+  Image.fromarray(
+      out_arr.view(np.uint8).reshape(output_height, width, 4),
+      "RGBA").save(out_file)
   print("\n" + OKBLUE + "Wrote {}".format(out_file) + ENDC)
   if not args.keep_captures:
     rm_captures(cap_dir, cap_file_prefix)